@@ -12,6 +12,8 @@ Usage:
     --iterations N   测试迭代次数 (默认 2000)
     --warmup N       预热次数 (默认 200)
     --output FILE    JSON 输出文件 (默认 /tmp/stability_v7_result.json)
+    --unix-socket PATH  通过 Unix domain socket 连接 (如 /tmp/mongodb-27019.sock)，忽略 --port
+    --parallel N     N 个连接并行运行测试 (默认 1，即串行测量延迟)
 """
 
 import socket
@@ -20,9 +22,23 @@ import time
 import json
 import random
 import argparse
-import statistics
+import math
+import itertools
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from collections import OrderedDict
+
+# 可选: pymongo 自带的 C 扩展 BSON 编解码，不可用时使用下方纯 Python 实现
+try:
+    import bson as _bson
+    from bson.errors import InvalidDocument as _InvalidDocument
+except ImportError:
+    _bson = None
+
+# 可选: NumPy 向量化统计计算
+try:
+    import numpy as _np
+except ImportError:
+    _np = None
 
 # ============================================================================
 # 配置常量
@@ -35,6 +51,8 @@ DEFAULT_ITERATIONS = 2000
 DEFAULT_WARMUP = 200
 OUTLIER_TRIM = 0.05  # 去除5%异常值
 RESET_SLEEP = 3  # F方案重置后等待秒数
+SOCK_BUF_SIZE = 1 << 20  # 收发缓冲区大小
+RECV_BUF_SIZE = 16384  # 每连接预分配的接收缓冲区，小响应一次 recv_into 读完
 
 # MongoDB Wire Protocol opcodes
 OP_REPLY = 1
@@ -56,119 +74,248 @@ BSON_NULL = 0x0A
 BSON_INT32 = 0x10
 BSON_INT64 = 0x12
 
-# 全局请求ID
-_request_id = 0
+# 全局请求ID (itertools.count 的 next 在 GIL 下是原子的，多连接并行时不会重复)
+_request_ids = itertools.count(1)
 
 def get_request_id():
-    global _request_id
-    _request_id += 1
-    return _request_id
+    return next(_request_ids)
 
 # ============================================================================
 # BSON 编解码
 # ============================================================================
 
-def bson_encode(doc):
-    """将Python字典编码为BSON二进制"""
+# 预编译的 struct 格式 (避免每次调用重复解析格式串及属性查找)
+_S_i = struct.Struct('<i')
+_S_q = struct.Struct('<q')
+_S_d = struct.Struct('<d')
+_S_ii = struct.Struct('<ii')
+_S_iiii = struct.Struct('<iiii')
+_S_iqii = struct.Struct('<iqii')
+
+_pack_i = _S_i.pack
+_pack_q = _S_q.pack
+_pack_d = _S_d.pack
+_pack_ii = _S_ii.pack
+_pack_iiii = _S_iiii.pack
+_pack_into_i = _S_i.pack_into
+_unpack_from_i = _S_i.unpack_from
+_unpack_from_q = _S_q.unpack_from
+_unpack_from_d = _S_d.unpack_from
+_unpack_from_iiii = _S_iiii.unpack_from
+_unpack_from_iqii = _S_iqii.unpack_from
+
+def _encode_null(buf, key_bytes, value):
+    buf.append(BSON_NULL)
+    buf += key_bytes
+
+def _encode_bool(buf, key_bytes, value):
+    buf.append(BSON_BOOL)
+    buf += key_bytes
+    buf.append(1 if value else 0)
+
+def _encode_int(buf, key_bytes, value):
+    if -2147483648 <= value <= 2147483647:
+        buf.append(BSON_INT32)
+        buf += key_bytes
+        buf += _pack_i(value)
+    else:
+        buf.append(BSON_INT64)
+        buf += key_bytes
+        buf += _pack_q(value)
+
+def _encode_float(buf, key_bytes, value):
+    buf.append(BSON_DOUBLE)
+    buf += key_bytes
+    buf += _pack_d(value)
+
+def _encode_str(buf, key_bytes, value):
+    str_bytes = value.encode('utf-8')
+    buf.append(BSON_STRING)
+    buf += key_bytes
+    buf += _pack_i(len(str_bytes) + 1)
+    buf += str_bytes
+    buf.append(0)
+
+def _encode_bytes(buf, key_bytes, value):
+    buf.append(BSON_BINARY)
+    buf += key_bytes
+    buf += _pack_i(len(value))
+    buf.append(0)  # subtype: generic
+    buf += value
+
+def _encode_doc(buf, key_bytes, value):
+    buf.append(BSON_DOCUMENT)
+    buf += key_bytes
+    bson_encode_into(buf, value)
+
+# 预计算的数组下标键 ("0\x00", "1\x00", ...)，避免逐元素 str(i) + encode
+_ARR_KEYS = [str(i).encode('ascii') + b'\x00' for i in range(256)]
+
+def _encode_array(buf, key_bytes, value):
+    # 数组编码为特殊文档，键为索引字符串；元素直接写入外层缓冲区，不构造中间字典
+    buf.append(BSON_ARRAY)
+    buf += key_bytes
+    start = len(buf)
+    buf += b'\x00\x00\x00\x00'  # 预留子文档长度
+    encoders = _ENCODERS
+    arr_keys = _ARR_KEYS
+    for i, item in enumerate(value):
+        encoder = encoders.get(type(item))
+        if encoder is None:
+            encoder = _lookup_encoder(type(item))
+        encoder(buf, arr_keys[i] if i < 256 else str(i).encode() + b'\x00', item)
+    buf.append(0)
+    _pack_into_i(buf, start, len(buf) - start)
+
+def _encode_oid(buf, key_bytes, value):
+    buf.append(BSON_OBJECTID)
+    buf += key_bytes
+    buf += value.binary
+
+def _lookup_encoder(value_type):
+    """按 MRO 查找子类 (如 collections.OrderedDict) 的编码函数，并缓存到分发表"""
+    for base in value_type.__mro__:
+        encoder = _ENCODERS.get(base)
+        if encoder is not None:
+            _ENCODERS[value_type] = encoder
+            return encoder
+    raise ValueError(f"Unsupported BSON type: {value_type}")
+
+if _bson is not None and _bson.has_c():
+    _c_encode = _bson.encode
+    _c_decode = _bson.decode
+else:
+    _c_encode = _c_decode = None
+
+def bson_encode_into(buf, doc):
+    """将Python字典编码为BSON，直接追加到调用方的 bytearray 末尾"""
     if doc is None:
-        return b'\x05\x00\x00\x00\x00'  # 空文档
+        buf += b'\x05\x00\x00\x00\x00'  # 空文档
+        return
 
-    body = b''
+    if _c_encode is not None:
+        try:
+            buf += _c_encode(doc)
+            return
+        except _InvalidDocument:
+            pass  # C 扩展不认识的类型 (如本地 ObjectId)，走纯 Python 路径
+
+    encoders = _ENCODERS
+    start = len(buf)
+    buf += b'\x00\x00\x00\x00'  # 预留文档长度
     for key, value in doc.items():
-        key_bytes = key.encode('utf-8') + b'\x00'
-
-        if value is None:
-            body += bytes([BSON_NULL]) + key_bytes
-        elif isinstance(value, bool):
-            body += bytes([BSON_BOOL]) + key_bytes + (b'\x01' if value else b'\x00')
-        elif isinstance(value, int):
-            if -2147483648 <= value <= 2147483647:
-                body += bytes([BSON_INT32]) + key_bytes + struct.pack('<i', value)
-            else:
-                body += bytes([BSON_INT64]) + key_bytes + struct.pack('<q', value)
-        elif isinstance(value, float):
-            body += bytes([BSON_DOUBLE]) + key_bytes + struct.pack('<d', value)
-        elif isinstance(value, str):
-            str_bytes = value.encode('utf-8') + b'\x00'
-            body += bytes([BSON_STRING]) + key_bytes + struct.pack('<i', len(str_bytes)) + str_bytes
-        elif isinstance(value, bytes):
-            body += bytes([BSON_BINARY]) + key_bytes + struct.pack('<i', len(value)) + b'\x00' + value
-        elif isinstance(value, dict):
-            subdoc = bson_encode(value)
-            body += bytes([BSON_DOCUMENT]) + key_bytes + subdoc
-        elif isinstance(value, (list, tuple)):
-            # 数组编码为特殊文档，键为索引字符串
-            array_doc = OrderedDict()
-            for i, item in enumerate(value):
-                array_doc[str(i)] = item
-            subdoc = bson_encode(array_doc)
-            body += bytes([BSON_ARRAY]) + key_bytes + subdoc
-        elif isinstance(value, ObjectId):
-            body += bytes([BSON_OBJECTID]) + key_bytes + value.binary
-        else:
-            raise ValueError(f"Unsupported BSON type: {type(value)}")
+        encoder = encoders.get(type(value))
+        if encoder is None:
+            encoder = _lookup_encoder(type(value))
+        encoder(buf, key.encode('utf-8') + b'\x00', value)
+
+    buf.append(0)  # 文档结束符
+    _pack_into_i(buf, start, len(buf) - start)
 
-    body += b'\x00'  # 文档结束符
-    return struct.pack('<i', len(body) + 4) + body
+def bson_encode(doc):
+    """将Python字典编码为BSON二进制"""
+    buf = bytearray()
+    bson_encode_into(buf, doc)
+    return bytes(buf)
+
+def _bson_element(key, value):
+    """单个 BSON 元素 (type + key + value) 的编码，用于预编码常量字段"""
+    return bson_encode({key: value})[4:-1]
+
+def _dec_double(data, pos):
+    return _unpack_from_d(data, pos)[0], pos + 8
+
+def _dec_str(data, pos):
+    str_len = _unpack_from_i(data, pos)[0]
+    pos += 4
+    # 不传编码名: 直接进入 UTF-8 解码器 (内置按字长扫描的 ASCII 快速路径)，省去编码名查找
+    return data[pos:pos + str_len - 1].decode(), pos + str_len
+
+def _dec_doc(data, pos):
+    return bson_decode(data, pos)
+
+def _dec_array(data, pos):
+    arr_dict, pos = bson_decode(data, pos)
+    return list(arr_dict.values()), pos
+
+def _dec_bin(data, pos):
+    bin_len = _unpack_from_i(data, pos)[0]
+    pos += 5  # 4 bytes len + 1 byte subtype
+    # 零拷贝: 返回接收缓冲区上的 memoryview 切片 (每个响应独占一个缓冲区)
+    return memoryview(data)[pos:pos + bin_len], pos + bin_len
+
+def _dec_oid(data, pos):
+    return ObjectId(bytes(data[pos:pos + 12])), pos + 12
+
+def _dec_bool(data, pos):
+    return data[pos] != 0, pos + 1
+
+def _dec_dt(data, pos):
+    return _unpack_from_q(data, pos)[0], pos + 8
+
+def _dec_null(data, pos):
+    return None, pos
+
+def _dec_i32(data, pos):
+    return _unpack_from_i(data, pos)[0], pos + 4
+
+def _dec_i64(data, pos):
+    return _unpack_from_q(data, pos)[0], pos + 8
+
+# 按 BSON 类型字节分发的解码表
+_DECODERS = {
+    BSON_DOUBLE: _dec_double,
+    BSON_STRING: _dec_str,
+    BSON_DOCUMENT: _dec_doc,
+    BSON_ARRAY: _dec_array,
+    BSON_BINARY: _dec_bin,
+    BSON_OBJECTID: _dec_oid,
+    BSON_BOOL: _dec_bool,
+    BSON_DATETIME: _dec_dt,
+    BSON_NULL: _dec_null,
+    BSON_INT32: _dec_i32,
+    BSON_INT64: _dec_i64,
+}
 
 def bson_decode(data, offset=0):
-    """从BSON二进制解码为Python字典"""
+    """从BSON二进制解码为Python字典
+
+    data 可以是 bytes / bytearray，或 recv_message 返回的 memoryview。
+    binary 字段解码为底层缓冲区上的 memoryview 切片，不复制；
+    C 扩展可用时按 pymongo 的类型映射解码 (ObjectId / datetime 为 bson 类型，binary 为 bytes)。
+    """
     if len(data) < offset + 4:
         return {}, offset
 
-    doc_len = struct.unpack_from('<i', data, offset)[0]
+    doc_len = _unpack_from_i(data, offset)[0]
     end = offset + doc_len
+    if _c_decode is not None:
+        return _c_decode(memoryview(data)[offset:end]), end
+
+    if type(data) is memoryview:
+        # 键名扫描与字符串解码需要 index/decode: 覆盖整个缓冲区的视图直接使用底层对象
+        base = data.obj
+        data = base if isinstance(base, (bytes, bytearray)) and data.nbytes == len(base) else data.tobytes()
+
     pos = offset + 4
-    result = OrderedDict()
+    result = {}
+    decoders = _DECODERS
 
     while pos < end - 1:
         type_byte = data[pos]
         pos += 1
 
-        # 读取键名
-        key_end = data.index(b'\x00', pos)
-        key = data[pos:key_end].decode('utf-8')
+        # 读取键名: int 针 + 文档边界限定的 memchr 扫描，未找到时不走异常路径
+        key_end = data.find(0, pos, end)
+        if key_end < 0:
+            raise ValueError(f"Unterminated BSON key at pos {pos}")
+        key = data[pos:key_end].decode()
         pos = key_end + 1
 
-        if type_byte == BSON_DOUBLE:
-            value = struct.unpack_from('<d', data, pos)[0]
-            pos += 8
-        elif type_byte == BSON_STRING:
-            str_len = struct.unpack_from('<i', data, pos)[0]
-            pos += 4
-            value = data[pos:pos + str_len - 1].decode('utf-8')
-            pos += str_len
-        elif type_byte == BSON_DOCUMENT:
-            value, pos = bson_decode(data, pos)
-        elif type_byte == BSON_ARRAY:
-            arr_dict, pos = bson_decode(data, pos)
-            value = list(arr_dict.values())
-        elif type_byte == BSON_BINARY:
-            bin_len = struct.unpack_from('<i', data, pos)[0]
-            pos += 5  # 4 bytes len + 1 byte subtype
-            value = data[pos:pos + bin_len]
-            pos += bin_len
-        elif type_byte == BSON_OBJECTID:
-            value = ObjectId(data[pos:pos + 12])
-            pos += 12
-        elif type_byte == BSON_BOOL:
-            value = data[pos] != 0
-            pos += 1
-        elif type_byte == BSON_DATETIME:
-            value = struct.unpack_from('<q', data, pos)[0]
-            pos += 8
-        elif type_byte == BSON_NULL:
-            value = None
-        elif type_byte == BSON_INT32:
-            value = struct.unpack_from('<i', data, pos)[0]
-            pos += 4
-        elif type_byte == BSON_INT64:
-            value = struct.unpack_from('<q', data, pos)[0]
-            pos += 8
-        else:
+        decoder = decoders.get(type_byte)
+        if decoder is None:
             raise ValueError(f"Unknown BSON type: {type_byte} at pos {pos}")
-
-        result[key] = value
+        result[key], pos = decoder(data, pos)
 
     return result, end
 
@@ -177,14 +324,15 @@ class ObjectId:
     _counter = random.randint(0, 0xFFFFFF)
     _machine = random.randbytes(3)
     _pid = random.randint(0, 0xFFFF)
+    _suffix = _machine + struct.pack('>H', _pid)  # 进程内不变的 machine + pid (5字节)
+    # timestamp(4) + suffix(5) + counter(3, 拆为高16位 + 低8位)，一次 pack 生成
+    _pack = struct.Struct('>I5sHB').pack
 
     def __init__(self, oid=None):
         if oid is None:
             # 生成新的 ObjectId
-            timestamp = struct.pack('>I', int(time.time()))
-            ObjectId._counter = (ObjectId._counter + 1) & 0xFFFFFF
-            counter = struct.pack('>I', ObjectId._counter)[1:]
-            self.binary = timestamp + ObjectId._machine + struct.pack('>H', ObjectId._pid) + counter
+            ObjectId._counter = counter = (ObjectId._counter + 1) & 0xFFFFFF
+            self.binary = ObjectId._pack(int(time.time()), ObjectId._suffix, counter >> 8, counter & 0xFF)
         elif isinstance(oid, bytes):
             self.binary = oid
         else:
@@ -196,41 +344,103 @@ class ObjectId:
     def __repr__(self):
         return f"ObjectId('{self}')"
 
+# 按具体类型分发的编码表 (bool 单独注册，不会误走 int 分支)
+_ENCODERS = {
+    type(None): _encode_null,
+    bool: _encode_bool,
+    int: _encode_int,
+    float: _encode_float,
+    str: _encode_str,
+    bytes: _encode_bytes,
+    dict: _encode_doc,
+    list: _encode_array,
+    tuple: _encode_array,
+    ObjectId: _encode_oid,
+}
+
 # ============================================================================
 # MongoDB Wire Protocol
 # ============================================================================
 
 def make_header(msg_len, request_id, response_to, opcode):
     """构建消息头 (16字节)"""
-    return struct.pack('<iiii', msg_len, request_id, response_to, opcode)
+    return _pack_iiii(msg_len, request_id, response_to, opcode)
+
+def _recv_exact(sock, view, size, error_msg):
+    """循环 recv_into 直到填满 view[:size]"""
+    got = 0
+    while got < size:
+        n = sock.recv_into(view[got:size])
+        if not n:
+            raise IOError(error_msg)
+        got += n
+
+# sendmsg 单次最多提交的 iovec 数 (Linux IOV_MAX)
+_IOV_MAX = 1024
+_HAS_SENDMSG = hasattr(socket.socket, 'sendmsg')
+
+def _send_buffers(sock, buffers):
+    """scatter-gather 发送多个缓冲区，避免用户态拼接 (无 sendmsg 时退化为 sendall)"""
+    if not _HAS_SENDMSG:
+        sock.sendall(b''.join(buffers))
+        return
+
+    buffers = list(buffers)
+    while buffers:
+        sent = sock.sendmsg(buffers[:_IOV_MAX])
+        # 跳过已完整发送的缓冲区，部分发送的截取剩余部分
+        i = 0
+        while i < len(buffers) and sent >= len(buffers[i]):
+            sent -= len(buffers[i])
+            i += 1
+        if sent:
+            buffers[i] = memoryview(buffers[i])[sent:]
+        del buffers[:i]
 
 def send_message(sock, opcode, body):
     """发送 Wire Protocol 消息并接收响应"""
     request_id = get_request_id()
     header = make_header(16 + len(body), request_id, 0, opcode)
-    sock.sendall(header + body)
-
-    # 接收响应头
-    resp_header = sock.recv(16)
-    if len(resp_header) < 16:
-        raise IOError("Failed to receive response header")
-
-    resp_len, resp_id, resp_to, resp_opcode = struct.unpack('<iiii', resp_header)
-
-    # 接收响应体
-    body_len = resp_len - 16
-    resp_body = b''
-    while len(resp_body) < body_len:
-        chunk = sock.recv(body_len - len(resp_body))
-        if not chunk:
-            raise IOError("Connection closed while receiving response")
-        resp_body += chunk
-
-    return resp_opcode, resp_body
+    _send_buffers(sock, (header, body))
+    return recv_message(sock)
+
+def recv_message(sock):
+    """接收一条 Wire Protocol 响应，返回 (opcode, body)
+
+    BufferedSocket 上先以一次 recv_into 读入连接的预分配缓冲区，完整装下的小响应
+    只需一次系统调用，body 复制为独立的 bytes (缓冲区下次调用会被覆盖)；
+    超出缓冲区的大响应另行分配，body 为其 memoryview，不再复制。
+    普通套接字退化为先读 16 字节消息头再读消息体。
+    """
+    rview = getattr(sock, 'rview', None)
+    if rview is None:
+        rview = memoryview(bytearray(16))
+
+    got = 0
+    while got < 16:
+        n = sock.recv_into(rview[got:])
+        if not n:
+            raise IOError("Failed to receive response header")
+        got += n
+    resp_len, resp_id, resp_to, resp_opcode = _unpack_from_iiii(rview, 0)
+
+    if got > resp_len:
+        # 每个连接同一时刻只有一个待回复请求，不应读到下一条消息
+        raise IOError(f"Unexpected {got - resp_len} bytes after response")
+
+    if resp_len <= len(rview):
+        _recv_exact(sock, rview[got:resp_len], resp_len - got, "Connection closed while receiving response")
+        return resp_opcode, bytes(rview[16:resp_len])
+
+    # 大响应: 一次分配，已读部分拷入后 recv_into 直接写入剩余部分
+    resp_view = memoryview(bytearray(resp_len - 16))
+    resp_view[:got - 16] = rview[16:got]
+    _recv_exact(sock, resp_view[got - 16:], resp_len - got, "Connection closed while receiving response")
+    return resp_opcode, resp_view
 
 def parse_op_reply(body):
     """解析 OP_REPLY 响应"""
-    flags, cursor_id, starting_from, num_returned = struct.unpack_from('<iqii', body, 0)
+    flags, cursor_id, starting_from, num_returned = _unpack_from_iqii(body, 0)
 
     documents = []
     offset = 20
@@ -246,15 +456,37 @@ def parse_op_reply(body):
         'documents': documents
     }
 
+# (db, collection) -> 以 \x00 结尾的完整命名空间 bytes
+_NS_CACHE = {}
+
+def _ns(db, collection):
+    """返回缓存的 "db.collection" 命名空间 (含结尾 NUL)"""
+    key = (db, collection)
+    full_name = _NS_CACHE.get(key)
+    if full_name is None:
+        full_name = f"{db}.{collection}".encode('utf-8') + b'\x00'
+        _NS_CACHE[key] = full_name
+    return full_name
+
 def send_op_query(sock, db, collection, query, fields=None, skip=0, limit=0, flags=0):
     """发送 OP_QUERY 并返回结果文档"""
-    full_name = f"{db}.{collection}".encode('utf-8') + b'\x00'
-    query_bson = bson_encode(query)
-    fields_bson = bson_encode(fields) if fields else b''
+    full_name = _ns(db, collection)
+
+    body = bytearray(_pack_i(flags))
+    body += full_name
+    body += _pack_ii(skip, limit)
+    bson_encode_into(body, query)
+    if fields:
+        bson_encode_into(body, fields)
 
-    body = struct.pack('<i', flags) + full_name + struct.pack('<ii', skip, limit) + query_bson + fields_bson
+    request_id = get_request_id()
+    header = make_header(16 + len(body), request_id, 0, OP_QUERY)
+    _send_buffers(sock, (header, body))
+    return recv_documents(sock)
 
-    opcode, resp_body = send_message(sock, OP_QUERY, body)
+def recv_documents(sock):
+    """接收 OP_REPLY 并返回结果文档"""
+    opcode, resp_body = recv_message(sock)
 
     if opcode != OP_REPLY:
         raise ValueError(f"Expected OP_REPLY, got {opcode}")
@@ -262,43 +494,104 @@ def send_op_query(sock, db, collection, query, fields=None, skip=0, limit=0, fla
     reply = parse_op_reply(resp_body)
     return reply['documents']
 
-def send_op_insert(sock, db, collection, documents, flags=0):
-    """发送 OP_INSERT"""
-    full_name = f"{db}.{collection}".encode('utf-8') + b'\x00'
+def _insert_message(db, collection, documents, flags=0):
+    """构建 OP_INSERT 消息，返回待发送的缓冲区元组"""
+    full_name = _ns(db, collection)
 
-    docs_bson = b''
+    # 所有文档直接编码进同一个可增长缓冲区，不产生中间 bytes
+    body = bytearray(_pack_i(flags))
+    body += full_name
     for doc in documents:
-        docs_bson += bson_encode(doc)
-
-    body = struct.pack('<i', flags) + full_name + docs_bson
+        bson_encode_into(body, doc)
 
-    # OP_INSERT 不返回响应，发送后直接返回
     request_id = get_request_id()
     header = make_header(16 + len(body), request_id, 0, OP_INSERT)
-    sock.sendall(header + body)
+    return header, body
 
-def send_op_update(sock, db, collection, selector, update, flags=0):
-    """发送 OP_UPDATE"""
-    full_name = f"{db}.{collection}".encode('utf-8') + b'\x00'
-    selector_bson = bson_encode(selector)
-    update_bson = bson_encode(update)
+def _update_message(db, collection, selector, update, flags=0):
+    """构建 OP_UPDATE 消息，返回待发送的缓冲区元组"""
+    full_name = _ns(db, collection)
 
-    body = struct.pack('<i', 0) + full_name + struct.pack('<i', flags) + selector_bson + update_bson
+    body = bytearray(_pack_i(0))
+    body += full_name
+    body += _pack_i(flags)
+    bson_encode_into(body, selector)
+    bson_encode_into(body, update)
 
     request_id = get_request_id()
     header = make_header(16 + len(body), request_id, 0, OP_UPDATE)
-    sock.sendall(header + body)
+    return header, body
 
-def send_op_delete(sock, db, collection, selector, flags=0):
-    """发送 OP_DELETE"""
-    full_name = f"{db}.{collection}".encode('utf-8') + b'\x00'
-    selector_bson = bson_encode(selector)
+def _delete_message(db, collection, selector, flags=0):
+    """构建 OP_DELETE 消息，返回待发送的缓冲区元组"""
+    full_name = _ns(db, collection)
 
-    body = struct.pack('<i', 0) + full_name + struct.pack('<i', flags) + selector_bson
+    body = bytearray(_pack_i(0))
+    body += full_name
+    body += _pack_i(flags)
+    bson_encode_into(body, selector)
 
     request_id = get_request_id()
     header = make_header(16 + len(body), request_id, 0, OP_DELETE)
-    sock.sendall(header + body)
+    return header, body
+
+# OP_INSERT / OP_UPDATE / OP_DELETE 不返回响应，发送后直接返回
+
+def send_op_insert_raw(sock, db, collection, docs_bson, flags=0):
+    """发送 OP_INSERT，docs_bson 为已编码、首尾相接的 BSON 文档序列"""
+    head = _pack_i(flags)
+    full_name = _ns(db, collection)
+    header = make_header(16 + len(head) + len(full_name) + len(docs_bson), get_request_id(), 0, OP_INSERT)
+    _send_buffers(sock, (header, head, full_name, docs_bson))
+
+def send_op_insert(sock, db, collection, documents, flags=0):
+    """发送 OP_INSERT"""
+    _send_buffers(sock, _insert_message(db, collection, documents, flags))
+
+def send_op_update(sock, db, collection, selector, update, flags=0):
+    """发送 OP_UPDATE"""
+    _send_buffers(sock, _update_message(db, collection, selector, update, flags))
+
+def send_op_delete(sock, db, collection, selector, flags=0):
+    """发送 OP_DELETE"""
+    _send_buffers(sock, _delete_message(db, collection, selector, flags))
+
+# ============================================================================
+# 连接
+# ============================================================================
+
+def _try_setsockopt(sock, level, name, value):
+    """设置可选的套接字选项，平台不支持时忽略"""
+    try:
+        sock.setsockopt(level, name, value)
+    except OSError:
+        pass
+
+class BufferedSocket(socket.socket):
+    """带预分配接收缓冲区的套接字 (见 recv_message)"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.rview = memoryview(bytearray(RECV_BUF_SIZE))
+
+def connect(host, port, unix_socket=None):
+    """建立到 mongod/mongos 的连接并调优套接字选项"""
+    if unix_socket:
+        # 本机连接绕过 TCP 协议栈
+        sock = BufferedSocket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(unix_socket)
+    else:
+        sock = BufferedSocket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.connect((host, port))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if hasattr(socket, "TCP_QUICKACK"):  # Linux: 立即 ACK，避免延迟确认引入抖动
+            _try_setsockopt(sock, socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
+
+    _try_setsockopt(sock, socket.SOL_SOCKET, socket.SO_RCVBUF, SOCK_BUF_SIZE)
+    _try_setsockopt(sock, socket.SOL_SOCKET, socket.SO_SNDBUF, SOCK_BUF_SIZE)
+    # 至少一个完整消息头到达才唤醒 recv
+    _try_setsockopt(sock, socket.SOL_SOCKET, socket.SO_RCVLOWAT, 16)
+    return sock
 
 # ============================================================================
 # 命令执行
@@ -315,6 +608,117 @@ def get_last_error(sock, db):
     """获取最后一次操作的错误信息"""
     return run_cmd(sock, db, {"getLastError": 1})
 
+# ============================================================================
+# 预编译请求
+# ============================================================================
+
+# 模板中的占位 int32，编码后定位其偏移，每轮迭代原地回填
+_P0, _P1, _P2, _P3, _P4 = _PATCH_SLOTS = tuple(0x7A5C0000 + k for k in range(5))
+
+class PreparedOp:
+    """预编译的 Wire Protocol 请求
+
+    body 以命名空间为界拆成 head / tail 两段，各只编码一次；发送时与缓存的
+    命名空间一起作为 iovec 提交。patch_fn(i) 返回本轮各占位符 (_P0, _P1...)
+    的取值，按预先定位的偏移 pack_into 到 tail 中。
+    """
+
+    def __init__(self, opcode, head, tail, patch_fn=None):
+        self.opcode = opcode
+        self.head = head
+        self.tail = tail
+        self.patch_fn = patch_fn
+        self.offsets = []
+
+        for slot in _PATCH_SLOTS:
+            packed = _pack_i(slot)
+            offset = tail.find(packed)
+            if offset < 0:
+                break
+            if tail.find(packed, offset + 1) >= 0:
+                raise ValueError(f"Ambiguous patch slot {slot:#x} in template")
+            self.offsets.append(offset)
+
+        if patch_fn is not None:
+            values = patch_fn(0)
+            if len(values) != len(self.offsets):
+                raise ValueError(f"patch_fn returns {len(values)} values for {len(self.offsets)} slots")
+        elif self.offsets:
+            raise ValueError("Template has patch slots but no patch_fn")
+        self.patch(0)
+
+    def patch(self, i):
+        """回填第 i 轮迭代的 int32 字段"""
+        if self.patch_fn is not None:
+            tail = self.tail
+            for offset, value in zip(self.offsets, self.patch_fn(i)):
+                _pack_into_i(tail, offset, value)
+
+def prepare_query(query, skip=0, limit=0, flags=0, patch_fn=None):
+    """预编译 OP_QUERY"""
+    tail = bytearray(_pack_ii(skip, limit))
+    bson_encode_into(tail, query)
+    return PreparedOp(OP_QUERY, _pack_i(flags), tail, patch_fn)
+
+def prepare_update(selector, update, flags=0, patch_fn=None):
+    """预编译 OP_UPDATE"""
+    tail = bytearray(_pack_i(flags))
+    bson_encode_into(tail, selector)
+    bson_encode_into(tail, update)
+    return PreparedOp(OP_UPDATE, _pack_i(0), tail, patch_fn)
+
+def prepare_delete(selector, flags=0, patch_fn=None):
+    """预编译 OP_DELETE"""
+    tail = bytearray(_pack_i(flags))
+    bson_encode_into(tail, selector)
+    return PreparedOp(OP_DELETE, _pack_i(0), tail, patch_fn)
+
+def _prepared_message(db, collection, op, i):
+    """回填第 i 轮取值并返回待发送的缓冲区元组"""
+    op.patch(i)
+    full_name = _ns(db, collection)
+    msg_len = 16 + len(op.head) + len(full_name) + len(op.tail)
+    header = make_header(msg_len, get_request_id(), 0, op.opcode)
+    return header, op.head, full_name, op.tail
+
+def send_prepared(sock, db, collection, op, i):
+    """发送预编译请求；OP_QUERY 返回结果文档，其余操作无响应"""
+    _send_buffers(sock, _prepared_message(db, collection, op, i))
+
+    if op.opcode != OP_QUERY:
+        return None
+    return recv_documents(sock)
+
+# ============================================================================
+# 写操作 + getLastError 流水线
+# ============================================================================
+
+_GET_LAST_ERROR = prepare_query({"getLastError": 1}, limit=1)
+
+def _send_write_with_gle(sock, db, write_buffers):
+    """写消息与 getLastError 查询合并为一次 sendmsg 发出，只等待一次响应"""
+    _send_buffers(sock, write_buffers + _prepared_message(db, "$cmd", _GET_LAST_ERROR, 0))
+    docs = recv_documents(sock)
+    if docs:
+        return docs[0]
+    return {}
+
+def send_op_insert_with_gle(sock, db, collection, documents, flags=0):
+    """发送 OP_INSERT + getLastError，返回 getLastError 结果"""
+    return _send_write_with_gle(sock, db, _insert_message(db, collection, documents, flags))
+
+def send_op_update_with_gle(sock, db, collection, selector, update, flags=0):
+    """发送 OP_UPDATE + getLastError，返回 getLastError 结果"""
+    return _send_write_with_gle(sock, db, _update_message(db, collection, selector, update, flags))
+
+def send_op_delete_with_gle(sock, db, collection, selector, flags=0):
+    """发送 OP_DELETE + getLastError，返回 getLastError 结果"""
+    return _send_write_with_gle(sock, db, _delete_message(db, collection, selector, flags))
+
+def send_prepared_with_gle(sock, db, collection, op, i):
+    """发送预编译写请求 + getLastError，返回 getLastError 结果"""
+    return _send_write_with_gle(sock, db, _prepared_message(db, collection, op, i))
+
 # ============================================================================
 # F方案重置
 # ============================================================================
@@ -352,25 +756,29 @@ def setup_simple_collection(sock, db):
         "indexes": [{"key": {"userId": 1}, "name": "userId_1"}]
     })
 
-    # 插入初始数据用于查询测试
-    initial_docs = []
-    for i in range(1000):
-        initial_docs.append({
-            "userId": i,
-            "name": f"user_{i}",
-            "age": 20 + (i % 50),
-            "status": ["active", "inactive", "pending"][i % 3],
-            "score": random.randint(0, 100)
-        })
-
-    # 分批插入
+    # 插入初始数据用于查询测试: 随机列一次生成，取值有限的字段预编码
+    num_docs = 1000
+    scores = [random.randint(0, 100) for _ in range(num_docs)]
+    statuses = [_bson_element("status", v) for v in ["active", "inactive", "pending"]]
+
+    # 分批插入: 按已知 schema 直接编码进批量缓冲区，不构造中间 dict
     batch_size = 100
-    for i in range(0, len(initial_docs), batch_size):
-        batch = initial_docs[i:i+batch_size]
-        send_op_insert(sock, db, "simple_docs", batch)
+    for first in range(0, num_docs, batch_size):
+        body = bytearray()
+        for i in range(first, first + batch_size):
+            start = len(body)
+            body += b'\x00\x00\x00\x00'
+            _encode_int(body, b'userId\x00', i)
+            _encode_str(body, b'name\x00', f"user_{i}")
+            _encode_int(body, b'age\x00', 20 + (i % 50))
+            body += statuses[i % 3]
+            _encode_int(body, b'score\x00', scores[i])
+            body.append(0)
+            _pack_into_i(body, start, len(body) - start)
+        send_op_insert_raw(sock, db, "simple_docs", body)
 
     get_last_error(sock, db)  # 确保写入完成
-    print(f"    Inserted {len(initial_docs)} initial documents")
+    print(f"    Inserted {num_docs} initial documents")
 
 def setup_complex_collection(sock, db):
     """设置复杂表 - 分片键 + 5个二级索引"""
@@ -392,29 +800,38 @@ def setup_complex_collection(sock, db):
         ]
     })
 
-    # 插入初始数据
-    initial_docs = []
-    for i in range(1000):
-        initial_docs.append({
-            "userId": i,
-            "email": f"user{i}@example.com",
-            "name": f"User {i}",
-            "age": 20 + (i % 50),
-            "status": ["active", "inactive", "pending"][i % 3],
-            "category": ["A", "B", "C", "D"][i % 4],
-            "score": random.randint(0, 100),
-            "createdAt": int(time.time()) - random.randint(0, 86400 * 30),
-            "tags": [f"tag{j}" for j in range(i % 5)],
-            "metadata": {"version": 1, "source": "benchmark"}
-        })
+    # 插入初始数据: 随机列一次生成，取值有限的字段预编码
+    num_docs = 1000
+    now = int(time.time())
+    scores = [random.randint(0, 100) for _ in range(num_docs)]
+    created = [now - random.randint(0, 86400 * 30) for _ in range(num_docs)]
+    statuses = [_bson_element("status", v) for v in ["active", "inactive", "pending"]]
+    categories = [_bson_element("category", v) for v in ["A", "B", "C", "D"]]
+    tags = [_bson_element("tags", [f"tag{j}" for j in range(k)]) for k in range(5)]
+    metadata = _bson_element("metadata", {"version": 1, "source": "benchmark"})
 
     batch_size = 100
-    for i in range(0, len(initial_docs), batch_size):
-        batch = initial_docs[i:i+batch_size]
-        send_op_insert(sock, db, "complex_docs", batch)
+    for first in range(0, num_docs, batch_size):
+        body = bytearray()
+        for i in range(first, first + batch_size):
+            start = len(body)
+            body += b'\x00\x00\x00\x00'
+            _encode_int(body, b'userId\x00', i)
+            _encode_str(body, b'email\x00', f"user{i}@example.com")
+            _encode_str(body, b'name\x00', f"User {i}")
+            _encode_int(body, b'age\x00', 20 + (i % 50))
+            body += statuses[i % 3]
+            body += categories[i % 4]
+            _encode_int(body, b'score\x00', scores[i])
+            _encode_int(body, b'createdAt\x00', created[i])
+            body += tags[i % 5]
+            body += metadata
+            body.append(0)
+            _pack_into_i(body, start, len(body) - start)
+        send_op_insert_raw(sock, db, "complex_docs", body)
 
     get_last_error(sock, db)
-    print(f"    Inserted {len(initial_docs)} initial documents")
+    print(f"    Inserted {num_docs} initial documents")
 
 # ============================================================================
 # 测试用例
@@ -425,60 +842,69 @@ def setup_complex_collection(sock, db):
 def test_simple_insert_single(sock, db, coll, i):
     """单条插入"""
     doc = {"userId": 10000 + i, "name": f"test_{i}", "age": 25, "score": i % 100}
-    send_op_insert(sock, db, coll, [doc])
-    get_last_error(sock, db)
+    send_op_insert_with_gle(sock, db, coll, [doc])
 
 def test_simple_insert_batch(sock, db, coll, i):
     """批量10条插入"""
     docs = [{"userId": 20000 + i * 10 + j, "name": f"batch_{i}_{j}", "age": 25 + j, "score": j * 10}
             for j in range(10)]
-    send_op_insert(sock, db, coll, docs)
-    get_last_error(sock, db)
+    send_op_insert_with_gle(sock, db, coll, docs)
 
+_SIMPLE_QUERY_EXACT = prepare_query({"userId": _P0}, limit=1, patch_fn=lambda i: (i % 1000,))
 def test_simple_query_exact(sock, db, coll, i):
     """精确匹配分片键"""
-    send_op_query(sock, db, coll, {"userId": i % 1000}, limit=1)
+    send_prepared(sock, db, coll, _SIMPLE_QUERY_EXACT, i)
 
+_SIMPLE_QUERY_GT = prepare_query({"userId": {"$gt": _P0}}, limit=10, patch_fn=lambda i: (i % 900,))
 def test_simple_query_gt(sock, db, coll, i):
     """范围查询 $gt"""
-    send_op_query(sock, db, coll, {"userId": {"$gt": i % 900}}, limit=10)
+    send_prepared(sock, db, coll, _SIMPLE_QUERY_GT, i)
 
+_SIMPLE_QUERY_OR = prepare_query({"$or": [{"userId": _P0}, {"userId": _P1}]}, limit=10,
+                                 patch_fn=lambda i: (i % 500, (i + 100) % 500))
 def test_simple_query_or(sock, db, coll, i):
     """OR 条件查询"""
-    send_op_query(sock, db, coll, {"$or": [{"userId": i % 500}, {"userId": (i + 100) % 500}]}, limit=10)
+    send_prepared(sock, db, coll, _SIMPLE_QUERY_OR, i)
 
+_SIMPLE_QUERY_IN = prepare_query({"userId": {"$in": [_P0, _P1, _P2, _P3, _P4]}}, limit=10,
+                                 patch_fn=lambda i: [(i + j * 100) % 1000 for j in range(5)])
 def test_simple_query_in(sock, db, coll, i):
     """IN 查询"""
-    ids = [(i + j * 100) % 1000 for j in range(5)]
-    send_op_query(sock, db, coll, {"userId": {"$in": ids}}, limit=10)
+    send_prepared(sock, db, coll, _SIMPLE_QUERY_IN, i)
 
+_SIMPLE_QUERY_AND = prepare_query({"$and": [{"age": {"$gte": 25}}, {"age": {"$lte": 40}}]}, limit=10)
 def test_simple_query_and(sock, db, coll, i):
     """AND 条件查询"""
-    send_op_query(sock, db, coll, {"$and": [{"age": {"$gte": 25}}, {"age": {"$lte": 40}}]}, limit=10)
+    send_prepared(sock, db, coll, _SIMPLE_QUERY_AND, i)
 
+_SIMPLE_QUERY_PARTIAL = prepare_query({"age": _P0}, limit=10, patch_fn=lambda i: (25 + (i % 20),))
 def test_simple_query_partial(sock, db, coll, i):
     """部分键匹配"""
-    send_op_query(sock, db, coll, {"age": 25 + (i % 20)}, limit=10)
+    send_prepared(sock, db, coll, _SIMPLE_QUERY_PARTIAL, i)
 
+_SIMPLE_UPDATE_SINGLE = prepare_update({"userId": _P0}, {"$set": {"score": _P1}},
+                                      patch_fn=lambda i: (i % 1000, i % 100))
 def test_simple_update_single(sock, db, coll, i):
     """单条更新"""
-    send_op_update(sock, db, coll, {"userId": i % 1000}, {"$set": {"score": i % 100}})
-    get_last_error(sock, db)
+    send_prepared_with_gle(sock, db, coll, _SIMPLE_UPDATE_SINGLE, i)
 
+_SIMPLE_UPDATE_MULTI = prepare_update({"age": _P0}, {"$inc": {"score": 1}}, flags=2,  # MULTI flag
+                                     patch_fn=lambda i: (25 + (i % 10),))
 def test_simple_update_multi(sock, db, coll, i):
     """多条更新"""
-    send_op_update(sock, db, coll, {"age": 25 + (i % 10)}, {"$inc": {"score": 1}}, flags=2)  # MULTI flag
-    get_last_error(sock, db)
+    send_prepared_with_gle(sock, db, coll, _SIMPLE_UPDATE_MULTI, i)
 
+_SIMPLE_DELETE_SINGLE = prepare_delete({"userId": _P0}, flags=1,  # SINGLE flag
+                                      patch_fn=lambda i: (30000 + i,))
 def test_simple_delete_single(sock, db, coll, i):
     """单条删除"""
-    send_op_delete(sock, db, coll, {"userId": 30000 + i}, flags=1)  # SINGLE flag
-    get_last_error(sock, db)
+    send_prepared_with_gle(sock, db, coll, _SIMPLE_DELETE_SINGLE, i)
 
+_SIMPLE_DELETE_MULTI = prepare_delete({"userId": {"$gte": _P0, "$lt": _P1}},
+                                     patch_fn=lambda i: (40000 + i * 5, 40000 + i * 5 + 3))
 def test_simple_delete_multi(sock, db, coll, i):
     """多条删除"""
-    send_op_delete(sock, db, coll, {"userId": {"$gte": 40000 + i * 5, "$lt": 40000 + i * 5 + 3}})
-    get_last_error(sock, db)
+    send_prepared_with_gle(sock, db, coll, _SIMPLE_DELETE_MULTI, i)
 
 # === Complex 表测试 (15个) ===
 
@@ -496,8 +922,7 @@ def test_complex_insert_single(sock, db, coll, i):
         "tags": ["benchmark"],
         "metadata": {"version": 1}
     }
-    send_op_insert(sock, db, coll, [doc])
-    get_last_error(sock, db)
+    send_op_insert_with_gle(sock, db, coll, [doc])
 
 def test_complex_insert_batch(sock, db, coll, i):
     """批量10条插入"""
@@ -513,67 +938,77 @@ def test_complex_insert_batch(sock, db, coll, i):
         "tags": [f"tag{j}"],
         "metadata": {"version": 1}
     } for j in range(10)]
-    send_op_insert(sock, db, coll, docs)
-    get_last_error(sock, db)
+    send_op_insert_with_gle(sock, db, coll, docs)
 
+_COMPLEX_QUERY_EXACT = prepare_query({"userId": _P0}, limit=1, patch_fn=lambda i: (i % 1000,))
 def test_complex_query_exact(sock, db, coll, i):
     """精确匹配"""
-    send_op_query(sock, db, coll, {"userId": i % 1000}, limit=1)
+    send_prepared(sock, db, coll, _COMPLEX_QUERY_EXACT, i)
 
+_COMPLEX_QUERY_GT = prepare_query({"userId": {"$gt": _P0}}, limit=10, patch_fn=lambda i: (i % 900,))
 def test_complex_query_gt(sock, db, coll, i):
     """范围查询 $gt"""
-    send_op_query(sock, db, coll, {"userId": {"$gt": i % 900}}, limit=10)
+    send_prepared(sock, db, coll, _COMPLEX_QUERY_GT, i)
 
+_COMPLEX_QUERY_OR = prepare_query({"$or": [{"status": "active"}, {"category": "A"}]}, limit=10)
 def test_complex_query_or(sock, db, coll, i):
     """OR 条件查询"""
-    send_op_query(sock, db, coll, {"$or": [{"status": "active"}, {"category": "A"}]}, limit=10)
+    send_prepared(sock, db, coll, _COMPLEX_QUERY_OR, i)
 
+_COMPLEX_QUERY_RANGE = prepare_query({"age": {"$gte": 25, "$lte": 35}}, limit=20)
 def test_complex_query_range(sock, db, coll, i):
     """范围扫描"""
-    send_op_query(sock, db, coll, {"age": {"$gte": 25, "$lte": 35}}, limit=20)
+    send_prepared(sock, db, coll, _COMPLEX_QUERY_RANGE, i)
 
+_COMPLEX_QUERY_IN = prepare_query({"userId": {"$in": [_P0, _P1, _P2, _P3, _P4]}}, limit=10,
+                                  patch_fn=lambda i: [(i + j * 100) % 1000 for j in range(5)])
 def test_complex_query_in(sock, db, coll, i):
     """IN 查询"""
-    ids = [(i + j * 100) % 1000 for j in range(5)]
-    send_op_query(sock, db, coll, {"userId": {"$in": ids}}, limit=10)
+    send_prepared(sock, db, coll, _COMPLEX_QUERY_IN, i)
 
+_COMPLEX_QUERY_AND = prepare_query({"$and": [{"status": "active"}, {"age": {"$gte": 30}}]}, limit=10)
 def test_complex_query_and(sock, db, coll, i):
     """AND 条件查询"""
-    send_op_query(sock, db, coll, {"$and": [{"status": "active"}, {"age": {"$gte": 30}}]}, limit=10)
+    send_prepared(sock, db, coll, _COMPLEX_QUERY_AND, i)
 
+# 字符串取值按变体分别预编译
+_COMPLEX_QUERY_PARTIAL = [prepare_query({"category": c}, limit=10) for c in ["A", "B", "C", "D"]]
 def test_complex_query_partial(sock, db, coll, i):
     """部分键匹配"""
-    send_op_query(sock, db, coll, {"category": ["A", "B", "C", "D"][i % 4]}, limit=10)
+    send_prepared(sock, db, coll, _COMPLEX_QUERY_PARTIAL[i % 4], i)
 
 def test_complex_query_by_index(sock, db, coll, i):
     """二级索引查询"""
     send_op_query(sock, db, coll, {"email": f"user{i % 1000}@example.com"}, limit=1)
 
+_COMPLEX_UPDATE_SINGLE = prepare_update({"userId": _P0}, {"$set": {"score": _P1}},
+                                       patch_fn=lambda i: (i % 1000, i % 100))
 def test_complex_update_single(sock, db, coll, i):
     """单条更新"""
-    send_op_update(sock, db, coll, {"userId": i % 1000}, {"$set": {"score": i % 100}})
-    get_last_error(sock, db)
+    send_prepared_with_gle(sock, db, coll, _COMPLEX_UPDATE_SINGLE, i)
 
+_COMPLEX_UPDATE_INDEXED = [prepare_update({"userId": _P0}, {"$set": {"status": s}},
+                                          patch_fn=lambda i: (i % 1000,))
+                           for s in ["active", "inactive"]]
 def test_complex_update_indexed(sock, db, coll, i):
     """更新索引字段"""
-    send_op_update(sock, db, coll, {"userId": i % 1000}, {"$set": {"status": ["active", "inactive"][i % 2]}})
-    get_last_error(sock, db)
+    send_prepared_with_gle(sock, db, coll, _COMPLEX_UPDATE_INDEXED[i % 2], i)
 
+_COMPLEX_UPDATE_MULTI_IDX = [prepare_update({"userId": _P0}, {"$set": {"age": _P1, "category": c}},
+                                            patch_fn=lambda i: (i % 1000, 25 + (i % 30)))
+                             for c in ["A", "B", "C", "D"]]
 def test_complex_update_multi_idx(sock, db, coll, i):
     """多索引更新"""
-    send_op_update(sock, db, coll, {"userId": i % 1000},
-                   {"$set": {"age": 25 + (i % 30), "category": ["A", "B", "C", "D"][i % 4]}})
-    get_last_error(sock, db)
+    send_prepared_with_gle(sock, db, coll, _COMPLEX_UPDATE_MULTI_IDX[i % 4], i)
 
+_COMPLEX_DELETE_SINGLE = prepare_delete({"userId": _P0}, flags=1, patch_fn=lambda i: (30000 + i,))
 def test_complex_delete_single(sock, db, coll, i):
     """单条删除"""
-    send_op_delete(sock, db, coll, {"userId": 30000 + i}, flags=1)
-    get_last_error(sock, db)
+    send_prepared_with_gle(sock, db, coll, _COMPLEX_DELETE_SINGLE, i)
 
 def test_complex_delete_by_index(sock, db, coll, i):
     """按索引删除"""
-    send_op_delete(sock, db, coll, {"email": f"todelete{i}@example.com"}, flags=1)
-    get_last_error(sock, db)
+    send_op_delete_with_gle(sock, db, coll, {"email": f"todelete{i}@example.com"}, flags=1)
 
 # ============================================================================
 # 测试用例定义
@@ -616,12 +1051,31 @@ COMPLEX_TESTS = [
 # 统计计算
 # ============================================================================
 
+def _trimmed_stats(trimmed):
+    """对已排序、已去除异常值的样本计算 (avg, p50, stddev)"""
+    m = len(trimmed)
+    if _np is not None:
+        arr = _np.asarray(trimmed, dtype=_np.float64)
+        avg = float(arr.mean())
+        p50 = float(_np.median(arr))
+        stddev = float(arr.std(ddof=1)) if m > 1 else 0
+        return avg, p50, stddev
+
+    avg = math.fsum(trimmed) / m
+    mid = m // 2
+    p50 = trimmed[mid] if m % 2 else (trimmed[mid - 1] + trimmed[mid]) / 2
+    stddev = math.sqrt(math.fsum((t - avg) ** 2 for t in trimmed) / (m - 1)) if m > 1 else 0
+    return avg, p50, stddev
+
 def calc_stats(times):
-    """计算统计指标 (去除异常值)"""
+    """计算统计指标 (去除异常值)
+
+    times 为纳秒整数；各指标均与样本成线性关系，统计完成后统一换算为微秒。
+    """
     if not times:
         return None
 
-    # 排序
+    # 排序 (仅一次，后续分位数/极值直接按下标读取)
     sorted_times = sorted(times)
     n = len(sorted_times)
 
@@ -635,22 +1089,21 @@ def calc_stats(times):
     if not trimmed:
         trimmed = sorted_times
 
-    avg = statistics.mean(trimmed)
-    p50 = statistics.median(trimmed)
-    p95 = trimmed[int(len(trimmed) * 0.95)] if len(trimmed) > 1 else trimmed[0]
-    p99 = trimmed[int(len(trimmed) * 0.99)] if len(trimmed) > 1 else trimmed[0]
-    min_val = min(trimmed)
-    max_val = max(trimmed)
-    stddev = statistics.stdev(trimmed) if len(trimmed) > 1 else 0
+    m = len(trimmed)
+    avg, p50, stddev = _trimmed_stats(trimmed)
+    p95 = trimmed[int(m * 0.95)] if m > 1 else trimmed[0]
+    p99 = trimmed[int(m * 0.99)] if m > 1 else trimmed[0]
+    min_val = trimmed[0]
+    max_val = trimmed[-1]
 
     return {
-        "avg": round(avg, 2),
-        "p50": round(p50, 2),
-        "p95": round(p95, 2),
-        "p99": round(p99, 2),
-        "min": round(min_val, 2),
-        "max": round(max_val, 2),
-        "stddev": round(stddev, 2),
+        "avg": round(avg * 1e-3, 2),
+        "p50": round(p50 * 1e-3, 2),
+        "p95": round(p95 * 1e-3, 2),
+        "p99": round(p99 * 1e-3, 2),
+        "min": round(min_val * 1e-3, 2),
+        "max": round(max_val * 1e-3, 2),
+        "stddev": round(stddev * 1e-3, 2),
         "count": len(times)
     }
 
@@ -667,19 +1120,31 @@ def run_warmup(sock, db, coll, test_func, warmup_count):
             pass
 
 def run_test(sock, db, coll, test_func, iterations):
-    """运行测试并收集延迟"""
+    """运行测试并收集延迟 (纳秒整数，换算在 calc_stats 中统一进行)"""
     times = []
     for i in range(iterations):
-        start = time.perf_counter()
+        start = time.perf_counter_ns()
         try:
             test_func(sock, db, coll, i)
-            elapsed = (time.perf_counter() - start) * 1_000_000  # 转换为微秒
-            times.append(elapsed)
+            times.append(time.perf_counter_ns() - start)
         except Exception as e:
             # 记录错误但继续
             pass
     return times
 
+def run_one_test(sock, db, coll, name, func, iterations, warmup):
+    """预热 + 正式测试，返回 (结果, 输出摘要)"""
+    # 预热
+    run_warmup(sock, db, coll, func, warmup)
+
+    # 正式测试
+    times = run_test(sock, db, coll, func, iterations)
+    stats = calc_stats(times)
+
+    if stats:
+        return {"name": name, **stats}, f"avg: {stats['avg']:.1f}us  p50: {stats['p50']:.1f}us"
+    return {"name": name, "error": "no data"}, "SKIP (no data)"
+
 def run_all_tests(sock, db, coll, tests, iterations, warmup):
     """运行所有测试"""
     results = []
@@ -687,22 +1152,37 @@ def run_all_tests(sock, db, coll, tests, iterations, warmup):
 
     for idx, (name, func) in enumerate(tests):
         print(f"  {idx+1}/{total} {name}...", end=" ", flush=True)
+        result, summary = run_one_test(sock, db, coll, name, func, iterations, warmup)
+        print(summary)
+        results.append(result)
 
-        # 预热
-        run_warmup(sock, db, coll, func, warmup)
+    return results
 
-        # 正式测试
-        times = run_test(sock, db, coll, func, iterations)
-        stats = calc_stats(times)
+def run_all_tests_parallel(connect_fn, db, coll, tests, iterations, warmup, parallel):
+    """将测试按轮转分片到 parallel 个连接上并行运行
 
-        if stats:
-            print(f"avg: {stats['avg']:.1f}us  p50: {stats['p50']:.1f}us")
-            results.append({"name": name, **stats})
-        else:
-            print("SKIP (no data)")
-            results.append({"name": name, "error": "no data"})
+    每个工作线程独占一个连接 (套接字不支持并发收发)，只共享只读的测试定义；
+    结果按原测试顺序合并。各测试的预编译请求只被其所在分片使用。
+    """
+    total = len(tests)
+    shards = [list(enumerate(tests))[k::parallel] for k in range(parallel)]
 
-    return results
+    def run_shard(shard):
+        sock = connect_fn()
+        try:
+            shard_results = []
+            for idx, (name, func) in shard:
+                result, summary = run_one_test(sock, db, coll, name, func, iterations, warmup)
+                print(f"  {idx+1}/{total} {name}... {summary}", flush=True)
+                shard_results.append((idx, result))
+            return shard_results
+        finally:
+            sock.close()
+
+    with ThreadPoolExecutor(max_workers=parallel) as executor:
+        merged = [r for shard_results in executor.map(run_shard, shards) for r in shard_results]
+
+    return [result for _, result in sorted(merged, key=lambda r: r[0])]
 
 # ============================================================================
 # 结果输出
@@ -728,7 +1208,7 @@ def print_summary(simple_results, complex_results):
         if "error" not in r:
             print(f"{r['name']:<25} {r['avg']:>10.1f} {r['p50']:>10.1f} {r['p95']:>10.1f} {r['stddev']:>10.1f}")
 
-def save_json(simple_results, complex_results, output_file):
+def save_json(simple_results, complex_results, output_file, parallel=1):
     """保存JSON结果"""
     result = {
         "simple": simple_results,
@@ -737,7 +1217,8 @@ def save_json(simple_results, complex_results, output_file):
         "config": {
             "iterations": DEFAULT_ITERATIONS,
             "warmup": DEFAULT_WARMUP,
-            "outlier_trim": OUTLIER_TRIM
+            "outlier_trim": OUTLIER_TRIM,
+            "parallel": parallel
         }
     }
 
@@ -756,7 +1237,12 @@ def main():
     parser.add_argument("--iterations", type=int, default=DEFAULT_ITERATIONS, help="Test iterations")
     parser.add_argument("--warmup", type=int, default=DEFAULT_WARMUP, help="Warmup iterations")
     parser.add_argument("--output", default="/tmp/stability_v7_result.json", help="Output JSON file")
+    parser.add_argument("--unix-socket", metavar="PATH", help="Connect via Unix domain socket instead of TCP")
+    parser.add_argument("--parallel", type=int, default=1, metavar="N",
+                        help="Run tests on N connections in parallel (1 = serial latency mode)")
     args = parser.parse_args()
+    if args.parallel < 1:
+        parser.error("--parallel must be >= 1")
 
     iterations = args.iterations
     warmup = args.warmup
@@ -764,16 +1250,24 @@ def main():
     print("=" * 60)
     print("Stability Benchmark v7 - F-Scheme E2E Test")
     print("=" * 60)
-    print(f"Target: {DEFAULT_HOST}:{args.port}")
-    print(f"Iterations: {args.iterations}, Warmup: {args.warmup}")
+    print(f"Target: {args.unix_socket or f'{DEFAULT_HOST}:{args.port}'}")
+    print(f"Iterations: {args.iterations}, Warmup: {args.warmup}, Parallel: {args.parallel}")
     print(f"Outlier trim: {OUTLIER_TRIM * 100}%")
+    print(f"BSON codec: {'C (pymongo)' if _c_encode is not None else 'pure Python'}")
     print()
 
     # 连接
     print("Connecting...")
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    sock.connect((DEFAULT_HOST, args.port))
-    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    def connect_fn():
+        return connect(DEFAULT_HOST, args.port, args.unix_socket)
+
+    def run_tests(coll, tests):
+        if args.parallel > 1:
+            return run_all_tests_parallel(connect_fn, DEFAULT_DB, coll, tests,
+                                          args.iterations, args.warmup, args.parallel)
+        return run_all_tests(sock, DEFAULT_DB, coll, tests, args.iterations, args.warmup)
+
+    sock = connect_fn()
 
     # 测试连接
     result = run_cmd(sock, "admin", {"ping": 1})
@@ -788,7 +1282,7 @@ def main():
     f_scheme_reset(sock, DEFAULT_DB)
     setup_simple_collection(sock, DEFAULT_DB)
     print()
-    simple_results = run_all_tests(sock, DEFAULT_DB, "simple_docs", SIMPLE_TESTS, args.iterations, args.warmup)
+    simple_results = run_tests("simple_docs", SIMPLE_TESTS)
 
     # === Complex 表测试 ===
     print("\n[Phase 2] Complex Table Tests (15 tests)")
@@ -796,11 +1290,11 @@ def main():
     f_scheme_reset(sock, DEFAULT_DB)
     setup_complex_collection(sock, DEFAULT_DB)
     print()
-    complex_results = run_all_tests(sock, DEFAULT_DB, "complex_docs", COMPLEX_TESTS, args.iterations, args.warmup)
+    complex_results = run_tests("complex_docs", COMPLEX_TESTS)
 
     # 输出结果
     print_summary(simple_results, complex_results)
-    save_json(simple_results, complex_results, args.output)
+    save_json(simple_results, complex_results, args.output, args.parallel)
 
     sock.close()
     print("\nBenchmark completed!")